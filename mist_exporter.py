@@ -11,13 +11,148 @@ Last Change: 22.01.2024 M. Lueckert
 """
 
 import sys
+import os
+import time
+import hashlib
+import stat
+import tempfile
 import argparse
 import requests as req
+from requests.adapters import HTTPAdapter
 import urllib3
+from urllib3.util.retry import Retry
 import json
 import logging
 from logging.handlers import RotatingFileHandler
 import re
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+try:
+    # orjson parses the API responses considerably faster than the json module
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Headers sent with every call to the MIST API besides the authorization
+API_HEADERS = {"Content-Type": "application/json"}
+# Connect and default read timeout in seconds for every call to the MIST API
+API_CONNECT_TIMEOUT = 5
+API_READ_TIMEOUT = 30
+# Number of sites queried in parallel
+MAX_WORKERS = 16
+# Number of devices per page of the org level device stats
+BULK_PAGE_LIMIT = 1000
+# Directory for the cached API responses. It must be private to the user
+# running the exporter, so it lives in the user's cache directory.
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "mist_exporter",
+)
+
+# String values from the API which are mapped to int metric values
+VALUE_MAP = {
+    "connected": 0,
+    "false": 0,
+    "fullyredundant": 0,
+    "disconnected": 1,
+    "true": 1,
+    "upgrading": 2,
+    "restarting": 3,
+}
+
+# Metrics exported for every AP device in the format
+# (metric_name, path to the value in the device json, extra labels)
+# The extra labels are preformatted and appended after the hostname label.
+DEVICE_METRICS = (
+    ("mist_device_uptime_seconds", ("uptime",), ""),
+    ("mist_device_status", ("status",), ""),
+    ("mist_device_power_constrained", ("power_constrained",), ""),
+    ("mist_device_last_seen_seconds", ("last_seen",), ""),
+    ("mist_device_num_clients", ("num_clients",), ""),
+    (
+        "mist_device_port_stat_tx_bytes",
+        ("port_stat", "eth0", "tx_bytes"),
+        ', ifname="eth0"',
+    ),
+    (
+        "mist_device_port_stat_rx_bytes",
+        ("port_stat", "eth0", "rx_bytes"),
+        ', ifname="eth0"',
+    ),
+    (
+        "mist_device_radio_stat_util_all",
+        ("radio_stat", "band_6", "util_all"),
+        ', band="6"',
+    ),
+    (
+        "mist_device_radio_stat_util_all",
+        ("radio_stat", "band_5", "util_all"),
+        ', band="5"',
+    ),
+    (
+        "mist_device_radio_stat_util_all",
+        ("radio_stat", "band_24", "util_all"),
+        ', band="24"',
+    ),
+)
+
+# Metrics exported for every edge device in the format
+# (metric_name, path to the value in the device json, extra labels)
+# The extra labels are preformatted and appended after the hostname label.
+# The PSU and fan redundancy metrics are derived from the redundancy state
+# and are added in iter_edge_metrics.
+EDGE_METRICS = (
+    ("mist_edge_uptime_seconds", ("uptime",), ""),
+    ("mist_edge_status", ("status",), ""),
+    ("mist_edge_cpu_usage_pct", ("cpu_stat", "usage"), ""),
+    ("mist_edge_memory_usage_pct", ("memory_stat", "usage"), ""),
+    (
+        "mist_edge_temperatures_degree",
+        ("sensor_stat", "temperatures", "CPU1", "degree"),
+        ', component="cpu1"',
+    ),
+    (
+        "mist_edge_temperatures_degree",
+        ("sensor_stat", "temperatures", "CPU2", "degree"),
+        ', component="cpu2"',
+    ),
+    (
+        "mist_edge_temperatures_degree",
+        ("sensor_stat", "temperatures", "Exhaust", "degree"),
+        ', component="exhaust"',
+    ),
+    (
+        "mist_edge_temperatures_degree",
+        ("sensor_stat", "temperatures", "Inlet", "degree"),
+        ', component="inlet"',
+    ),
+)
+
+
+def check_metric_specs(metrics):
+    """Checks that the metric names and label keys are lowercase.
+
+    The names and labels are written as they are, so they are checked once
+    at import instead of being lowercased for every metric. Label values
+    may be mixed case.
+
+    Args:
+        metrics: Metric specs in the format of DEVICE_METRICS.
+
+    Raises:
+        ValueError: If a metric name or label key is not lowercase.
+    """
+    for name, _, extra_labels in metrics:
+        label_keys = re.findall(r'(\w+)="', extra_labels)
+        for key in [name, *label_keys]:
+            if key != key.lower():
+                raise ValueError(f"Metric spec {name} {extra_labels} is not lowercase")
+
+
+check_metric_specs(DEVICE_METRICS + EDGE_METRICS)
 
 
 def main(arguments):
@@ -48,55 +183,165 @@ def main(arguments):
     parser.add_argument(
         "--baseurl", help="API URL if not EU", default="https://api.eu.mist.com/api/v1"
     )
+    parser.add_argument(
+        "--api_timeout",
+        help="Seconds to wait for a response of the MIST API before the call is retried.",
+        type=float,
+        default=API_READ_TIMEOUT,
+    )
+    parser.add_argument(
+        "--sites_cache_ttl",
+        help="Seconds the site list is cached on disk. 0 disables the cache.",
+        type=int,
+        default=300,
+    )
+    parser.add_argument(
+        "--devices_cache_ttl",
+        help="Seconds the device stats of a site are cached on disk. 0 disables the cache.",
+        type=int,
+        default=30,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory for the cached API responses. Must be owned by the user running the exporter and not writable by others.",
+        default=CACHE_DIR,
+    )
+    parser.add_argument(
+        "--bulk",
+        help="Retrieve the devices of all sites with paged org level requests instead of one request per site.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="Number of sites queried in parallel.",
+        type=int,
+        default=MAX_WORKERS,
+    )
     args = parser.parse_args(arguments)
+    try:
+        configure_logging(args.log_fullpath, args.debug)
+    except OSError as e:
+        # Without a logfile there is nowhere to report errors, but the
+        # status metric must still be printed
+        print("mist_exporter_status 0")
+        print(f"Could not open logfile {args.log_fullpath}: {e}", file=sys.stderr)
+        return
+    logging.info("Mist Exporter starting")
 
     try:
-        api_token = args.api_token
-        org_id = args.org_id
-        baseurl = args.baseurl
-        site_name_filter = args.site_name_filter
-        log_fullpath = args.log_fullpath
-        logformat = "%(asctime)s:%(levelname)s:%(funcName)s:%(message)s"
-        handler = RotatingFileHandler(
-            filename=log_fullpath, maxBytes=(5242880), backupCount=5, encoding="utf-8"
-        )
-        logging.basicConfig(handlers=[handler], level=logging.INFO, format=logformat)
-        if args.debug:
-            logging.getLogger().setLevel(logging.DEBUG)
-            for myhandler in logging.getLogger().handlers:
-                myhandler.setLevel(logging.DEBUG)
-        logging.info("Mist Exporter starting")
-        if args.ignore_ssl:
-            logging.info("Disable SSL verification")
-            urllib3.disable_warnings()
-            verify = False
-        else:
-            verify = True
-        headers = {
-            "Authorization": f"Token {api_token}",
-            "Content-Type": "application/json",
-        }
-
-        sites = get_sites(baseurl, org_id, site_name_filter, headers, verify)
-        # self_info = get_self(baseurl, headers)
-        siteids = [x["id"] for x in sites]
-        devices = get_devices(baseurl, siteids, headers, verify)
-        device_metrics_dict = get_device_metrics(devices)
-        edge_metrics_dict = get_edge_metrics(
-            f"{baseurl}/orgs/{org_id}", headers, verify
-        )
-        metrics = device_metrics_dict + edge_metrics_dict
-        metrics.append("mist_exporter_status 1")
-        print("\n".join(metrics))
+        run(args)
         logging.info("All went fine. Prometheus metrics printed to stdout.")
 
-    except Exception as e:
+    except Exception:
         print("mist_exporter_status 0")
         logging.exception("An error occured. See error details.")
 
     logging.info("Mist Exporter finished")
 
 
+@functools.lru_cache(maxsize=1)
+def get_log_handler(log_fullpath) -> RotatingFileHandler:
+    """Creates the rotating logfile handler once per logfile path."""
+    return RotatingFileHandler(
+        filename=log_fullpath, maxBytes=(5242880), backupCount=5, encoding="utf-8"
+    )
+
+
+def configure_logging(log_fullpath, debug):
+    """Configures the root logger to write to the rotating logfile.
+
+    Args:
+        log_fullpath: Location of the logfile.
+        debug: True to set the loglevel to debug.
+    """
+    logformat = "%(asctime)s:%(levelname)s:%(funcName)s:%(message)s"
+    handler = get_log_handler(log_fullpath)
+    logging.basicConfig(handlers=[handler], level=logging.INFO, format=logformat)
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+        for myhandler in logging.getLogger().handlers:
+            myhandler.setLevel(logging.DEBUG)
+
+
+def run(args):
+    """Retrieves all metrics from MIST API and prints them to stdout.
+
+    Args:
+        args: The parsed command line arguments.
+    """
+    api_token = args.api_token
+    org_id = args.org_id
+    baseurl = args.baseurl
+    site_name_filter = args.site_name_filter
+    if args.ignore_ssl:
+        logging.info("Disable SSL verification")
+        urllib3.disable_warnings()
+        verify = False
+    else:
+        verify = True
+    headers = {"Authorization": f"Token {api_token}", **API_HEADERS}
+    sites_cache_ttl = args.sites_cache_ttl
+    devices_cache_ttl = args.devices_cache_ttl
+    if (sites_cache_ttl > 0 or devices_cache_ttl > 0) and not prepare_cache_dir(
+        args.cache_dir
+    ):
+        sites_cache_ttl = devices_cache_ttl = 0
+
+    # One extra connection for the edge devices fetched next to the sites
+    pool_size = args.max_workers + 1
+    with get_session(
+        headers, verify, pool_size, args.api_timeout
+    ) as session, ThreadPoolExecutor(max_workers=1) as executor:
+        # The edge devices do not depend on the sites, so they are
+        # retrieved while the sites and their devices are queried
+        edge_future = executor.submit(
+            get_edge_devices, f"{baseurl}/orgs/{org_id}", session
+        )
+        sites = get_sites(
+            baseurl,
+            org_id,
+            site_name_filter,
+            session,
+            sites_cache_ttl,
+            args.cache_dir,
+        )
+        # self_info = get_self(baseurl, session)
+        siteids = [x["id"] for x in sites]
+        devices = None
+        if args.bulk:
+            devices = get_org_devices(baseurl, org_id, siteids, session)
+        if devices is None:
+            devices = get_devices(
+                baseurl,
+                siteids,
+                session,
+                args.max_workers,
+                devices_cache_ttl,
+                args.cache_dir,
+            )
+        edge_devices = edge_future.result()
+    # All API calls are done. The metrics are formatted while they are
+    # written to stdout.
+    metrics = itertools.chain(
+        iter_device_metrics(devices),
+        iter_edge_metrics(edge_devices),
+        ["mist_exporter_status 1"],
+    )
+    # The lines are written as UTF-8 bytes to the binary stdout. The
+    # Prometheus text format is UTF-8 regardless of the locale of the host.
+    sys.stdout.flush()
+    sys.stdout.buffer.writelines(f"{metric}\n".encode("utf-8") for metric in metrics)
+    sys.stdout.buffer.flush()
+
+
+class MistApiError(Exception):
+    """Raised if the MIST API returns an error status code."""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
 def test_status_code(response):
     """
     Raises an exception if the response status code is not 200 (OK).
@@ -105,14 +350,204 @@ def test_status_code(response):
         response: The response object from an API call (e.g., requests.Response).  Must have a `status_code` and `reason` attribute.
 
     Raises:
-        Exception: If the status code is not 200. The exception message includes the status code and reason.
+        MistApiError: If the status code is not 200. The exception message includes the status code, reason, url and the start of the response body.
     """
     if response.status_code != 200:
-        message = f"MIST API returned an error {response.status_code} {response.reason}"
-        raise Exception(message)
+        message = f"MIST API returned an error {response.status_code} {response.reason} for {response.url}: {response.text[:200]}"
+        raise MistApiError(message, response.status_code)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter which applies a default timeout to every request."""
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+def get_session(
+    headers, verify, pool_size=MAX_WORKERS, timeout=API_READ_TIMEOUT
+) -> req.Session:
+    """Creates a HTTP session for the MIST API.
+
+    All API calls share this session so the TCP/TLS connection to the API
+    is kept alive and reused instead of being reopened for every request.
+    Transient errors (5xx server errors, connection errors and read
+    timeouts) are retried with a short backoff. Retry-After headers are
+    ignored, because they may ask for a wait of hours. A rate limited call
+    (429) is not retried, so the scrape fails fast instead of sending more
+    requests with a throttled token. A single call makes at most four
+    attempts, so in the worst case it takes about
+    4 * (API_CONNECT_TIMEOUT + timeout) seconds plus about 2 seconds backoff.
+
+    Args:
+        headers: The authentication headers required for the API.
+        verify: False to ignore self signed certificates in chain.
+        pool_size: Number of connections kept alive to the API. Should match
+            the number of parallel requests.
+        timeout: Seconds to wait for a response before the call is retried.
+
+    Returns:
+        A requests.Session to be used for all API calls.
+    """
+    retries = Retry(
+        total=3,
+        connect=3,
+        read=2,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=False,
+    )
+    # All calls go to the same API host, so a single connection pool is enough
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=retries,
+        timeout=(API_CONNECT_TIMEOUT, timeout),
+    )
+    session = req.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(headers)
+    session.verify = verify
+    return session
+
+
+def get_json(session, url, cache_ttl=0, cache_dir=CACHE_DIR, params=None):
+    """Retrieves a json document from MIST API.
+
+    The response body is parsed directly from the raw bytes, which skips
+    the charset detection of response.json().
+    If cache_ttl is set the response is cached on disk and reused by
+    following runs until it is older than cache_ttl seconds.
+
+    Args:
+        session: The HTTP session returned by get_session.
+        url: The full url of the API endpoint.
+        cache_ttl: Seconds a cached response is valid. 0 disables the cache.
+        cache_dir: Directory for the cached responses.
+        params: Optional query parameters. Responses with params are not cached.
+
+    Returns:
+        The parsed json object.
+    """
+    return get_json_response(session, url, cache_ttl, cache_dir, params)[0]
+
+
+def get_json_response(session, url, cache_ttl=0, cache_dir=CACHE_DIR, params=None):
+    """Retrieves a json document and the response headers from MIST API.
+
+    See get_json for the arguments.
+
+    Returns:
+        A tuple with the parsed json object and the response headers. The
+        headers are empty if the json object was read from the cache.
+    """
+    if params:
+        cache_ttl = 0
+    cache_file = None
+    if cache_ttl > 0:
+        cache_key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        cache_file = os.path.join(cache_dir, f"{cache_key}.json")
+        cached = read_cache(cache_file, cache_ttl)
+        if cached is not None:
+            logging.debug(f"Using cached response for {url}")
+            return cached, {}
+    response = session.get(url, params=params)
+    test_status_code(response)
+    if cache_file:
+        write_cache(cache_file, response.content)
+    return json_loads(response.content), response.headers
 
 
-def get_sites(baseurl, org_id, site_filter, headers, verify) -> list:
+def prepare_cache_dir(cache_dir) -> bool:
+    """Creates the cache directory and checks that it is private.
+
+    Cached responses are trusted and contain org and device data, so the
+    directory must be owned by the current user and must not be writable
+    by group or others. Otherwise the cache is not used.
+
+    Args:
+        cache_dir: Directory for the cached responses.
+
+    Returns:
+        True if the cache directory can be used.
+    """
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        st = os.lstat(cache_dir)
+    except OSError:
+        logging.warning(f"Could not create cache dir {cache_dir}", exc_info=True)
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        logging.warning(f"Cache dir {cache_dir} is not a directory. Cache disabled.")
+        return False
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        logging.warning(
+            f"Cache dir {cache_dir} is not owned by the current user. Cache disabled."
+        )
+        return False
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        logging.warning(
+            f"Cache dir {cache_dir} is writable by group or others. Cache disabled."
+        )
+        return False
+    return True
+
+
+def read_cache(cache_file, cache_ttl):
+    """Reads a cached API response.
+
+    Args:
+        cache_file: Path of the cache file.
+        cache_ttl: Seconds the cache file is valid.
+
+    Returns:
+        The parsed json object or None if there is no valid cache file.
+    """
+    try:
+        if time.time() - os.path.getmtime(cache_file) > cache_ttl:
+            return None
+        with open(cache_file, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(cache_file, content):
+    """Writes an API response to the cache.
+
+    The file is written to a temporary file first and then renamed, so
+    concurrent runs never read a partially written file. The cache dir
+    must have been checked with prepare_cache_dir before.
+    Errors are logged and otherwise ignored because the cache is optional.
+
+    Args:
+        cache_file: Path of the cache file.
+        content: The raw response body.
+    """
+    tmp_file = None
+    try:
+        # mkstemp creates a new file exclusively and never follows a symlink
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        logging.warning(f"Could not write cache file {cache_file}", exc_info=True)
+
+
+def get_sites(
+    baseurl, org_id, site_filter, session, cache_ttl=0, cache_dir=CACHE_DIR
+) -> list:
     """Retrieves sites from MIST API.
 
     Retrieves sites from the API. Can be filtered with site_filter.
@@ -122,333 +557,307 @@ def get_sites(baseurl, org_id, site_filter, headers, verify) -> list:
         org_id: The organisation ID.
         site_filter: A valid regex string. If the returned sitename
             matches this regex it will be considered for further processing.
-        headers: The authentication headers required for the API.
+        session: The HTTP session returned by get_session.
+        cache_ttl: Seconds the site list is cached. 0 disables the cache.
+        cache_dir: Directory for the cached responses.
 
     Returns:
         A list with the filtered json object of the sites.
     """
     url = f"{baseurl}/orgs/{org_id}/sites"
-    response = req.get(url, headers=headers, verify=verify)
-    test_status_code(response)
-    sites = response.json()
+    sites = get_json(session, url, cache_ttl, cache_dir)
     site_count = len(sites)
-    sites_filtered = []
-    for site in sites:
-        if re.match(site_filter, site["name"]):
-            sites_filtered.append(site)
+    if site_filter == ".*":
+        # The default filter matches every site
+        sites_filtered = sites
+    else:
+        site_pattern = re.compile(site_filter)
+        sites_filtered = [site for site in sites if site_pattern.match(site["name"])]
     site_count_filtered = len(sites_filtered)
     logging.info(
         f"Got {site_count} site(s) from API. {site_count_filtered} site(s) after filtering with filter {site_filter}"
     )
-    logging.debug(str(sites_filtered))
+    logging.debug("%s", sites_filtered)
     return sites_filtered
 
 
-def get_edge_metrics(baseurl, headers, verify) -> list:
+def get_edge_devices(baseurl, session) -> list:
     """Retrieves edge device stats from MIST API.
 
     Retrieves edge device stats from the API.
 
     Args:
         baseurl: The baseurl of the MIST API.
-        siteids: List with all siteids to look for devices.
-        headers: The authentication headers required for the API.
+        session: The HTTP session returned by get_session.
 
     Returns:
-        A list with json object of all device details.
+        A list with json object of all edge device details.
     """
-    devices = []
     url = f"{baseurl}/stats/mxedges"
-    response = req.get(url, headers=headers, verify=verify)
-    test_status_code(response)
-    devices = response.json()
-    logging.debug(str(devices))
-    metrics_list = []
+    devices = get_json(session, url)
+    logging.debug("%s", devices)
+    return devices
+
+
+def iter_edge_metrics(devices: list):
+    """Retrieves the defined metrics from the edge device json.
+
+    If a metric is not found we log it, add a value of 0 and an error label.
+
+    Args:
+        devices: json with all edge devices where we want the metrics.
+
+    Yields:
+        The metric strings in Prometheus format one by one.
+    """
+    metric_count = 0
     for device in devices:
-        device_name = get_value_from_path(device, "name")
+        device_name = get_value_from_path(device, ("name",))
         if not device_name:
             continue
-        metric_list = [
-            ["mist_edge_uptime_seconds", get_value_from_path(device, "uptime"), {}],
-            ["mist_edge_status", get_value_from_path(device, "status"), {}],
-            [
-                "mist_edge_cpu_usage_pct",
-                get_value_from_path(device, "cpu_stat.usage"),
-                {},
-            ],
-            [
-                "mist_edge_memory_usage_pct",
-                get_value_from_path(device, "memory_stat.usage"),
-                {},
-            ],
-            [
-                "mist_edge_temperatures_degree",
-                get_value_from_path(device, "sensor_stat.temperatures.CPU1.degree"),
-                {"component": "cpu1"},
-            ],
-            [
-                "mist_edge_temperatures_degree",
-                get_value_from_path(device, "sensor_stat.temperatures.CPU2.degree"),
-                {"component": "cpu2"},
-            ],
-            [
-                "mist_edge_temperatures_degree",
-                get_value_from_path(device, "sensor_stat.temperatures.Exhaust.degree"),
-                {"component": "exhaust"},
-            ],
-            [
-                "mist_edge_temperatures_degree",
-                get_value_from_path(device, "sensor_stat.temperatures.Inlet.degree"),
-                {"component": "inlet"},
-            ],
-            [
-                "mist_edge_psu_redundancies",
-                get_psu_redundancy(device),
-                {
-                    "redundancy": get_value_from_path(
-                        device, "sensor_stat.redundancies.PS.state"
-                    )
-                },
-            ],
-            [
-                "mist_edge_fan_redundancies",
-                get_fan_redundancy(device),
-                {
-                    "redundancy": get_value_from_path(
-                        device, "sensor_stat.redundancies.Fan.state"
-                    )
-                },
-            ],
-        ]
-        # These labels will be added to all metrics
-        all_labels_dict = {"hostname": device_name.upper()}
-        # These labels will be added to the device_info metric just for information purposes
-        details_labels_dict = {
-            "serial": get_value_from_path(device, "serial_no"),
-            "model": get_value_from_path(device, "model"),
-        }
-        metrics_list.append(
-            format_metric(
-                "mist_edge_info", {**details_labels_dict, **all_labels_dict}, 1
-            )
-        )
+        # This label will be added to all metrics
+        host_label = f'hostname="{str(device_name).upper()}"'
+        # These labels will be added to the edge_info metric just for information purposes
+        serial = get_label_from_path(device, ("serial_no",))
+        model = get_label_from_path(device, ("model",))
+        yield f'mist_edge_info{{serial="{serial}", model="{model}", {host_label}}} 1'
+        metric_count += 1
         # Merge of metrics and labels
-        for item in metric_list:
-            name = item[0]
-            value = item[1]
-            device_labels_dict = item[2]
-            metric_not_found_dict = {}
-            if value != "False":
+        for name, path, extra_labels in EDGE_METRICS:
+            value = get_value_from_path(device, path)
+            error_label = ""
+            if value is not None:
                 value = map_string_value_to_int(value)
             else:
                 value = 0
-                metric_not_found_dict = {"error": "Metric not found"}
+                error_label = ', error="Metric not found"'
                 logging.debug(
                     f"{device_name} - Metric {name} not found for device. Setting 0 value."
                 )
-            labels_merged = {
-                **all_labels_dict,
-                **device_labels_dict,
-                **metric_not_found_dict,
-            }
-            metrics_list.append(format_metric(name, labels_merged, value))
+            yield f"{name}{{{host_label}{extra_labels}{error_label}}} {value}"
+            metric_count += 1
+        psu_state = get_label_from_path(
+            device, ("sensor_stat", "redundancies", "PS", "state")
+        )
+        psu_value = get_redundancy(psu_state)
+        yield f'mist_edge_psu_redundancies{{{host_label}, redundancy="{psu_state}"}} {psu_value}'
+        fan_state = get_label_from_path(
+            device, ("sensor_stat", "redundancies", "Fan", "state")
+        )
+        fan_value = get_redundancy(fan_state)
+        yield f'mist_edge_fan_redundancies{{{host_label}, redundancy="{fan_state}"}} {fan_value}'
+        metric_count += 2
     device_count = len(devices)
-    metric_count = len(metrics_list)
     logging.info(
         f"Got {metric_count} metrics for {device_count} edge device(s) from API"
     )
-    metrics_list.append(format_metric("mist_edge_total_count", [], device_count))
-    metrics_list.append(format_metric("mist_edge_metric_total_count", [], metric_count))
-    return metrics_list
+    yield f"mist_edge_total_count{{}} {device_count}"
+    yield f"mist_edge_metric_total_count{{}} {metric_count}"
 
 
-def get_psu_redundancy(device_json):
-    value = get_value_from_path(device_json, "sensor_stat.redundancies.PS.state")
-    if value == "fullyredundant":
+def get_redundancy(state) -> int:
+    """Maps a PSU or fan redundancy state to 0 (fully redundant) or 1."""
+    if state == "fullyredundant":
         return 0
     else:
         return 1
 
 
-def get_fan_redundancy(device_json):
-    value = get_value_from_path(device_json, "sensor_stat.redundancies.Fan.state")
-    if value == "fullyredundant":
-        return 0
-    else:
-        return 1
+def get_site_devices(
+    baseurl, siteid, session, cache_ttl=0, cache_dir=CACHE_DIR
+) -> list:
+    """Retrieves the devices of a single site from MIST API.
 
+    Args:
+        baseurl: The baseurl of the MIST API.
+        siteid: The site ID to look for devices.
+        session: The HTTP session returned by get_session.
+        cache_ttl: Seconds the device stats are cached. 0 disables the cache.
+        cache_dir: Directory for the cached responses.
 
-def get_devices(baseurl, siteids: list, headers, verify) -> list:
+    Returns:
+        A list with json object of the device details of this site.
+    """
+    url = f"{baseurl}/sites/{siteid}/stats/devices"
+    return get_json(session, url, cache_ttl, cache_dir)
+
+
+def get_devices(
+    baseurl,
+    siteids: list,
+    session,
+    max_workers=MAX_WORKERS,
+    cache_ttl=0,
+    cache_dir=CACHE_DIR,
+) -> Iterator[dict]:
     """Retrieves devices from MIST API.
 
-    Retrieves devices from the API.
+    Retrieves devices from the API. The sites are queried in parallel
+    because the requests do not depend on each other.
 
     Args:
         baseurl: The baseurl of the MIST API.
         siteids: List with all siteids to look for devices.
-        headers: The authentication headers required for the API.
+        session: The HTTP session returned by get_session.
+        max_workers: Number of sites queried in parallel.
+        cache_ttl: Seconds the device stats are cached. 0 disables the cache.
+        cache_dir: Directory for the cached responses.
 
     Returns:
-        A list with json object of all device details.
+        An iterator over the json objects of all device details. All API
+        calls are finished when this function returns, the per-site
+        lists are just not copied into one list.
     """
-    json_list = []
-    for siteid in siteids:
-        url = f"{baseurl}/sites/{siteid}/stats/devices"
-        response = req.get(url, headers=headers, verify=verify)
-        test_status_code(response)
-        rjson = response.json()
-        if response.status_code != 200:
-            logging.warning(
-                f'Received http error {response.status_code} while retrieving device details for siteid "{siteid}". Json response: {str(rjson)}'
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(
+                lambda siteid: get_site_devices(
+                    baseurl, siteid, session, cache_ttl, cache_dir
+                ),
+                siteids,
             )
-        else:
-            json_list = json_list + rjson
-    logging.debug(str(json_list))
-    return json_list
-
-
-def get_self(baseurl, headers, verify) -> json:
-    url = f"{baseurl}/self"
-    response = req.get(url, headers=headers, verify=verify)
-    test_status_code(response)
-    return response.json()
+        )
+    logging.debug("%s", results)
+    return itertools.chain.from_iterable(results)
 
 
-def format_metric(metric_name: str, labeldict: dict, value: str) -> str:
-    """Creates a Prometheus metric string.
+def get_org_devices(baseurl, org_id, siteids: list, session):
+    """Retrieves the devices of all sites with the org level stats endpoint.
 
-    Returns a string in Prometheus format with metric, labels and value
+    The devices are retrieved page by page instead of one request per site
+    and are filtered by the given siteids afterwards.
 
     Args:
-        metric_name: The metric name.
-        labeldic: Dictionary with multiple label:labelvalue pairs.
-        value: The value of the metric
+        baseurl: The baseurl of the MIST API.
+        org_id: The organisation ID.
+        siteids: List with all siteids to look for devices.
+        session: The HTTP session returned by get_session.
 
     Returns:
-        A valid Prometheus metric string
-        mist_device_info{hostname="testdevice"} 255
+        A list with json object of all device details or None if the
+        org level endpoint is not available.
     """
-    string_labels = ""
-    if labeldict:
-        formatted_labels = [f'{x[0].lower()}="{x[1]}"' for x in labeldict.items()]
-        string_labels = ", ".join(formatted_labels)
-    time_series = f"{metric_name.lower()}{{{string_labels}}} {value}"
-    return time_series
-
-
-def get_value_from_path(dictionary, parts):
-    """extracts a value from a dictionary using a dotted path string"""
-    if type(parts) is str:
-        parts = parts.split(".")
-    try:
-        if len(parts) > 1:
-            return get_value_from_path(dictionary[parts[0]], parts[1:])
-        return str(dictionary[parts[0]]).lower()
-    except KeyError:
+    url = f"{baseurl}/orgs/{org_id}/stats/devices"
+    siteids = set(siteids)
+    devices = []
+    seen = set()
+    fetched = 0
+    page = 0
+    while True:
+        page += 1
+        params = {"limit": BULK_PAGE_LIMIT, "page": page}
+        try:
+            page_devices, headers = get_json_response(session, url, params=params)
+        except MistApiError as e:
+            if e.status_code == 404 and page == 1:
+                logging.warning(
+                    "Org level device stats not available. Falling back to one request per site."
+                )
+                return None
+            raise
+        # The API may cap the page size below the requested limit, so the
+        # devices actually received are counted. A server ignoring the page
+        # parameter returns the same devices again, which ends the loop.
+        new_devices = [x for x in page_devices if get_device_key(x) not in seen]
+        if not new_devices:
+            break
+        seen.update(get_device_key(x) for x in new_devices)
+        fetched += len(new_devices)
+        devices.extend(x for x in new_devices if x.get("site_id") in siteids)
+        total = headers.get("X-Page-Total")
+        page_limit = headers.get("X-Page-Limit")
+        if total is not None:
+            if fetched >= int(total):
+                break
+        elif page_limit is not None and len(page_devices) < int(page_limit):
+            break
+    logging.info(f"Got {len(devices)} device(s) in {page} page(s) from API")
+    logging.debug("%s", devices)
+    return devices
+
+
+def get_device_key(device) -> str:
+    """Returns a key identifying a device across the pages of the API."""
+    return device.get("id") or device.get("mac") or json.dumps(device, sort_keys=True)
+
+
+def get_self(baseurl, session) -> json:
+    url = f"{baseurl}/self"
+    return get_json(session, url)
+
+
+def get_value_from_path(dictionary, parts: tuple):
+    """extracts a value from a dictionary using a tuple of keys
+
+    Returns None if the value is not present."""
+    value = dictionary
+    for part in parts:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def get_label_from_path(dictionary, parts: tuple) -> str:
+    """extracts a lowercase label value from a dictionary using a tuple of keys
+
+    Returns "False" if the value is not present."""
+    value = get_value_from_path(dictionary, parts)
+    if value is None:
         return "False"
+    return str(value).lower()
 
 
-def get_device_metrics(devices: dict) -> list:
+def iter_device_metrics(devices: Iterable[dict]):
     """Retrieves the defined metrics from the device json.
 
     If a metric is not found we log it and add a value of 0 (maybe not ideal in all cases).
-    To add new metrics for devices add them to the metric_list variable
+    Metrics of a port or radio band the device does not have are skipped.
+    To add new metrics for devices add them to the DEVICE_METRICS constant
 
     Args:
-        devices: json with all devices where we want the metrics.
+        devices: Iterable with the json of all devices where we want the metrics.
 
-    Returns:
-        List will all metric strings in Prometheus format.
+    Yields:
+        The metric strings in Prometheus format one by one.
     """
-    count = len(devices)
-    logging.info(f"Getting information for {count} devices from API")
-    metrics_list = []
-    metrics_list.append("# HELP mist_device Mist device metrics")
+    device_count = 0
+    yield "# HELP mist_device Mist device metrics"
+    metric_count = 1
     for device in devices:
-        device_name = get_value_from_path(device, "name")
+        device_count += 1
+        device_name = get_value_from_path(device, ("name",))
         if not device_name:
             continue
-        # The metric_list dict has the following format
-        # [metric_name, value from json, {dict with labels}]
-        metric_list = [
-            ["mist_device_uptime_seconds", get_value_from_path(device, "uptime"), {}],
-            ["mist_device_status", get_value_from_path(device, "status"), {}],
-            [
-                "mist_device_power_constrained",
-                get_value_from_path(device, "power_constrained"),
-                {},
-            ],
-            [
-                "mist_device_last_seen_seconds",
-                get_value_from_path(device, "last_seen"),
-                {},
-            ],
-            ["mist_device_num_clients", get_value_from_path(device, "num_clients"), {}],
-            [
-                "mist_device_port_stat_tx_bytes",
-                get_value_from_path(device, "port_stat.eth0.tx_bytes"),
-                {"ifName": "eth0"},
-            ],
-            [
-                "mist_device_port_stat_rx_bytes",
-                get_value_from_path(device, "port_stat.eth0.rx_bytes"),
-                {"ifName": "eth0"},
-            ],
-            [
-                "mist_device_radio_stat_util_all",
-                get_value_from_path(device, "radio_stat.band_6.util_all"),
-                {"band": "6"},
-            ],
-            [
-                "mist_device_radio_stat_util_all",
-                get_value_from_path(device, "radio_stat.band_5.util_all"),
-                {"band": "5"},
-            ],
-            [
-                "mist_device_radio_stat_util_all",
-                get_value_from_path(device, "radio_stat.band_24.util_all"),
-                {"band": "24"},
-            ],
-        ]
-
-        # These labels will be added to all metrics
-        all_labels_dict = {"hostname": device_name.upper()}
+        # This label will be added to all metrics
+        host_label = f'hostname="{str(device_name).upper()}"'
         # These labels will be added to the device_info metric just for information purposes
-        details_labels_dict = {
-            "serial": get_value_from_path(device, "serial"),
-            "model": get_value_from_path(device, "model"),
-            "hw_rev": get_value_from_path(device, "hw_rev"),
-        }
-        metrics_list.append(
-            format_metric(
-                "mist_device_info", {**details_labels_dict, **all_labels_dict}, 1
-            )
-        )
+        serial = get_label_from_path(device, ("serial",))
+        model = get_label_from_path(device, ("model",))
+        hw_rev = get_label_from_path(device, ("hw_rev",))
+        yield f'mist_device_info{{serial="{serial}", model="{model}", hw_rev="{hw_rev}", {host_label}}} 1'
+        metric_count += 1
         # Merge of metrics and labels
-        for item in metric_list:
-            name = item[0]
-            value = item[1]
-            device_labels_dict = item[2]
-            labels_merged = {**all_labels_dict, **device_labels_dict}
-            if value != "False":
+        for name, path, extra_labels in DEVICE_METRICS:
+            value = get_value_from_path(device, path)
+            if value is not None:
                 value = map_string_value_to_int(value)
+            elif len(path) > 1 and get_value_from_path(device, path[:-1]) is None:
+                # The device does not have this port or radio band at all
+                continue
             else:
                 value = 0
                 logging.debug(
                     f"{device_name} - Metric {name} not found for device. Setting 0 value."
                 )
-            metrics_list.append(format_metric(name, labels_merged, value))
-    device_count = len(devices)
-    metric_count = len(metrics_list)
+            yield f"{name}{{{host_label}{extra_labels}}} {value}"
+            metric_count += 1
     logging.info(f"Got {metric_count} metrics for {device_count} AP device(s) from API")
-    metrics_list.append(format_metric("mist_device_total_count", [], device_count))
-    metrics_list.append(
-        format_metric("mist_device_metric_total_count", [], metric_count)
-    )
-    return metrics_list
+    yield f"mist_device_total_count{{}} {device_count}"
+    yield f"mist_device_metric_total_count{{}} {metric_count}"
 
 
-def map_string_value_to_int(metric_value: str):
+def map_string_value_to_int(metric_value):
     """Map string values to bool.
 
     Some string values from the API needs to be mapped to int because we
@@ -460,16 +869,12 @@ def map_string_value_to_int(metric_value: str):
     Returns:
         Mapped int for the value defined
     """
-    if metric_value in ["connected", "false", "FullyRedundant"]:
-        return 0
-    elif metric_value in ["disconnected", "true"]:
-        return 1
-    elif metric_value in ["upgrading"]:
-        return 2
-    elif metric_value in ["restarting"]:
-        return 3
-    else:
+    if isinstance(metric_value, bool):
+        return int(metric_value)
+    if not isinstance(metric_value, str):
         return metric_value
+    metric_value = metric_value.lower()
+    return VALUE_MAP.get(metric_value, metric_value)
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ import pytest
 def run_mist_exporter(api_token, org_id):
     return run_mist_exporter_all(api_token, org_id, baseurl="")
 
-def run_mist_exporter_all(api_token, org_id, baseurl):
+def run_mist_exporter_all(api_token, org_id, baseurl, extra_args=()):
     """Runs mist_exporter.py and returns its output."""
     try:
         myargs = [
@@ -22,6 +22,7 @@ def run_mist_exporter_all(api_token, org_id, baseurl):
         if baseurl:
             myargs.append("--baseurl")
             myargs.append(baseurl)
+        myargs.extend(extra_args)
         process = subprocess.run(
             myargs,
             capture_output=True,
@@ -44,9 +45,16 @@ def test_wrong_url_should_error(api_token, org_id):
 def test_successful_exporter_status(mist_api_output):
     assert "mist_exporter_status 1" in mist_api_output
 
+def test_bulk_exporter_status(api_token, org_id):
+    output = run_mist_exporter_all(api_token, org_id, "", ["--bulk"])
+    assert "mist_exporter_status 1" in output
+
 def test_no_empty_hostnames(mist_api_output):
     assert 'mist_device_uptime_seconds{hostname=""}' not in mist_api_output
 
+def test_no_unnamed_devices(mist_api_output):
+    assert 'hostname="FALSE"' not in mist_api_output
+
 # Pytest Fixture to get API token and Org ID from environment variables
 @pytest.fixture(scope="session")
 def api_token():